@@ -7,7 +7,16 @@ from dotenv import load_dotenv
 import sys
 import asyncio
 import aiohttp
-from datetime import datetime, timedelta
+import json
+import time
+import traceback
+from datetime import date, datetime, timedelta, timezone
+
+try:
+    import orjson
+    json_loads = orjson.loads  # much faster decoder for the GitHub payloads
+except ImportError:
+    json_loads = json.loads
 
 # -------------------- WINDOWS EVENT LOOP FIX --------------------
 if sys.platform.startswith("win"):
@@ -23,101 +32,383 @@ if not TOKEN:
 if not GITHUB_TOKEN:
     raise ValueError("GITHUB_TOKEN not found in .env")
 
+# Built once and attached to the shared session; GitHub accepts the "token"
+# scheme for both REST and GraphQL
+REST_HEADERS = {"Authorization": f"token {GITHUB_TOKEN}"}
+
 # -------------------- BOT SETUP --------------------
+class TrackerBot(commands.Bot):
+    async def setup_hook(self):
+        global DB, HTTP_SESSION
+        DB = await aiosqlite.connect(DB_PATH)
+        DB.row_factory = aiosqlite.Row
+        await _tune(DB)
+        await init_db(DB)
+        rows = await DB.execute_fetchall(_SQL_SELECT_CHANNELS)
+        CHANNEL_CACHE.update({row["guild_id"]: row["update_channel_id"] for row in rows})
+        HTTP_SESSION = aiohttp.ClientSession(
+            headers=REST_HEADERS,
+            connector=aiohttp.TCPConnector(limit=50, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=75),
+        )
+        check_commits.start()
+
+    async def close(self):
+        # Stop polling first so no cycle is left using DB/HTTP_SESSION below
+        check_commits.cancel()
+        task = check_commits.get_task()
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+        await super().close()
+        # Shared resources are closed last so in-flight handlers can finish
+        global DB, HTTP_SESSION
+        if HTTP_SESSION is not None:
+            await HTTP_SESSION.close()
+            HTTP_SESSION = None
+        if DB is not None:
+            await DB.close()
+            DB = None
+
 intents = discord.Intents.default()
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = TrackerBot(command_prefix="!", intents=intents)
 DB_PATH = "github_bot.db"
+DB: aiosqlite.Connection | None = None  # single long-lived connection, opened in setup_hook
+DB_LOCK = asyncio.Lock()  # serializes write transactions on the shared connection
+HTTP_SESSION: aiohttp.ClientSession | None = None  # shared GitHub session, opened in setup_hook
+CHANNEL_CACHE: dict[int, int] = {}  # guild_id -> update_channel_id, mirrors the settings table
+UPDATE_CHANNELS: dict[int, discord.abc.Messageable] = {}  # guild_id -> resolved update channel
+POLL_INTERVAL = 60  # seconds; floor for the adaptive check_commits interval
+NEXT_POLL: dict[int, float] = {}  # account id -> monotonic time its feed may be polled again
+POLL_SLACK = 1  # seconds of early polling tolerated against NEXT_POLL
+RATE_LIMIT = {"remaining": None, "reset": 0.0}  # latest GitHub REST quota headers
+RATE_LIMIT_FLOOR = 100  # pause REST calls until the reset below this many requests
+MAX_RETRIES = 6  # retries for rate-limited REST calls (1, 2, 4 ... 32s backoff floor)
+DISCORD_MESSAGE_LIMIT = 2000  # characters per Discord message
+MAX_NEW_EVENTS = 20  # push events considered per account per poll
+EVENTS_PER_PAGE = 30  # events feed page size; fixed so stored ETags keep matching
+MAX_EVENT_PAGES = 3  # feed pages read per poll; the next is fetched only while the page is all new and in the week
+MAX_COMMITS_PER_PUSH = 5  # newest commit lines listed per push before "...and N earlier"
+REPO_CACHE: dict[str, tuple[float, list[str]]] = {}  # username -> (fetched_at, public repo names)
+REPO_CACHE_TTL = 3600  # seconds; public repo lists change rarely
+STREAK_WINDOW_DAYS = 60  # days of contribution calendar fetched by the first streak query
+STREAK_MAX_WINDOW_DAYS = 365  # later windows; GitHub caps a from/to span at one year
 
 # -------------------- DATABASE --------------------
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS github_accounts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                github_username TEXT NOT NULL,
-                discord_id INTEGER,
-                last_event_id TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                guild_id INTEGER PRIMARY KEY,
-                update_channel_id INTEGER
+# Runtime statements live here so every call site sends byte-identical SQL
+# text, which is what sqlite3's per-connection statement cache is keyed on.
+# Edit them here rather than inlining variants at the call sites.
+_SQL_SELECT_ACCOUNTS = "SELECT id, github_username, last_event_id, etag, guild_id FROM github_accounts"
+_SQL_UPDATE_CURSOR = "UPDATE github_accounts SET last_event_id = ?, etag = ? WHERE id = ?"
+_SQL_SELECT_CHANNELS = "SELECT guild_id, update_channel_id FROM settings"
+_SQL_UPSERT_ACCOUNT = (
+    "INSERT INTO github_accounts (github_username, discord_id, last_event_id, guild_id) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(github_username COLLATE NOCASE) DO UPDATE SET discord_id = excluded.discord_id, guild_id = excluded.guild_id"
+)
+_SQL_SELECT_ACCOUNT_ID = "SELECT id FROM github_accounts WHERE github_username = ? COLLATE NOCASE"
+_SQL_DELETE_ACCOUNT = "DELETE FROM github_accounts WHERE github_username = ? COLLATE NOCASE"
+_SQL_SELECT_USER_ACCOUNTS = "SELECT github_username FROM github_accounts WHERE discord_id = ?"
+_SQL_SELECT_LINKS = "SELECT github_username, discord_id FROM github_accounts"
+_SQL_UPDATE_DISCORD = "UPDATE github_accounts SET discord_id = ? WHERE github_username = ? COLLATE NOCASE"
+_SQL_UPSERT_CHANNEL = "INSERT OR REPLACE INTO settings (guild_id, update_channel_id) VALUES (?, ?)"
+_SQL_SELECT_ETAG = "SELECT etag, body FROM etag_cache WHERE url = ?"
+_SQL_UPSERT_ETAG = "INSERT OR REPLACE INTO etag_cache (url, etag, body) VALUES (?, ?, ?)"
+
+async def _tune(db):
+    # WAL + synchronous=NORMAL keeps the small per-poll commits off the fsync path;
+    # an in-memory database has no journal file for WAL to use
+    if DB_PATH != ":memory:":
+        await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA cache_size=-64000")  # ~64 MiB page cache
+    await db.execute("PRAGMA mmap_size=134217728")  # 128 MiB memory-mapped reads
+    await db.execute("PRAGMA busy_timeout=5000")
+    await db.commit()
+
+async def init_db(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS github_accounts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            github_username TEXT NOT NULL,
+            discord_id INTEGER,
+            last_event_id TEXT,
+            etag TEXT,
+            guild_id INTEGER
+        )
+    """)
+    # Migrate databases created before these columns existed
+    columns = {row["name"] for row in await db.execute_fetchall("PRAGMA table_info(github_accounts)")}
+    for column, ddl in (("etag", "etag TEXT"), ("guild_id", "guild_id INTEGER")):
+        if column not in columns:
+            await db.execute(f"ALTER TABLE github_accounts ADD COLUMN {ddl}")
+    # Slash commands look accounts up by Discord user and by GitHub username
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_ga_discord ON github_accounts(discord_id)")
+    # A GitHub account is linked at most once, and logins are case-insensitive.
+    # One-time migration: collapse duplicate links left by older versions in
+    # any casing (keeping the newest) and enforce it with a unique index;
+    # once that index exists there is nothing left to collapse
+    indexes = {row["name"] for row in await db.execute_fetchall("PRAGMA index_list(github_accounts)")}
+    if "idx_ga_username_nocase" not in indexes:
+        await db.execute("DELETE FROM github_accounts WHERE id NOT IN (SELECT MAX(id) FROM github_accounts GROUP BY lower(github_username))")
+        await db.execute("DROP INDEX IF EXISTS idx_ga_username")
+        await db.execute("CREATE UNIQUE INDEX idx_ga_username_nocase ON github_accounts(github_username COLLATE NOCASE)")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            guild_id INTEGER PRIMARY KEY,
+            update_channel_id INTEGER
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS etag_cache (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            body BLOB
+        )
+    """)
+    await db.commit()
+
+# -------------------- HELPER: DISCORD MESSAGES --------------------
+def chunk_message(parts, sep="\n"):
+    # Pack parts into as few messages as Discord's length limit allows;
+    # a single oversized part is truncated rather than rejected
+    chunks, current = [], ""
+    for part in parts:
+        part = part[:DISCORD_MESSAGE_LIMIT]
+        if current and len(current) + len(sep) + len(part) > DISCORD_MESSAGE_LIMIT:
+            chunks.append(current)
+            current = part
+        else:
+            current = f"{current}{sep}{part}" if current else part
+    if current:
+        chunks.append(current)
+    return chunks
+
+def update_channel(guild):
+    # Resolved once per guild, so the name-based fallback doesn't scan every
+    # channel on each poll; set_github_channel replaces the entry
+    channel = UPDATE_CHANNELS.get(guild.id)
+    if channel is None:
+        channel_id = CHANNEL_CACHE.get(guild.id)
+        channel = bot.get_channel(channel_id) if channel_id else discord.utils.get(
+            guild.channels, name="github-activity"
+        )
+        if channel is not None:
+            UPDATE_CHANNELS[guild.id] = channel
+    return channel
+
+# -------------------- GITHUB API --------------------
+def _note_rate_limit(resp):
+    # The quota is per token, so the most recent response is authoritative
+    remaining = resp.headers.get("X-RateLimit-Remaining")
+    if remaining is not None:
+        RATE_LIMIT["remaining"] = int(remaining)
+        RATE_LIMIT["reset"] = float(resp.headers.get("X-RateLimit-Reset", 0))
+
+# GET a GitHub REST URL, pausing when the quota runs low and retrying
+# rate-limited responses. With an etag the request is conditional, and an
+# unchanged resource comes back as a bodyless 304 that costs no quota.
+# Returns (status, headers, data); data is the decoded JSON body for a 200
+# (the raw bytes with raw=True) and None otherwise. Slash commands pass
+# wait=False: instead of sleeping until the reset (up to an hour, past the
+# interaction's lifetime) they get a 429 back straight away.
+async def github_get(url, etag=None, raw=False, wait=True):
+    headers = {"If-None-Match": etag} if etag else None
+    for attempt in range(MAX_RETRIES + 1):
+        if RATE_LIMIT["remaining"] is not None and RATE_LIMIT["remaining"] < RATE_LIMIT_FLOOR:
+            if not wait and RATE_LIMIT["reset"] > time.time():
+                return 429, {}, None
+            await asyncio.sleep(max(RATE_LIMIT["reset"] - time.time(), 0))
+        async with HTTP_SESSION.get(url, headers=headers) as resp:
+            _note_rate_limit(resp)
+            retry_after = resp.headers.get("Retry-After")
+            rate_limited = resp.status in (403, 429) and (
+                retry_after is not None or resp.headers.get("X-RateLimit-Remaining") == "0"
             )
-        """)
-        await db.commit()
+            if rate_limited and not wait:
+                return 429, resp.headers, None
+            if not rate_limited or attempt == MAX_RETRIES:
+                data = None
+                if resp.status == 200:
+                    body = await resp.read()
+                    data = body if raw else json_loads(body)
+                return resp.status, resp.headers, data
+        # Honour Retry-After (or the quota reset), backing off 1, 2, 4, ... seconds at least
+        delay = float(retry_after) if retry_after is not None else RATE_LIMIT["reset"] - time.time()
+        await asyncio.sleep(max(delay, 2 ** attempt))
+
+# Conditional GET backed by the etag_cache table, for resources without an
+# ETag column of their own. A 304 reuses the stored body, so the caller
+# always gets (200, data) for an unchanged resource.
+async def cached_get(url, wait=True):
+    rows = await DB.execute_fetchall(_SQL_SELECT_ETAG, (url,))
+    etag, body = (rows[0]["etag"], rows[0]["body"]) if rows else (None, None)
+    status, resp_headers, fresh = await github_get(url, etag, raw=True, wait=wait)
+    if status == 304 and body is not None:
+        return 200, json_loads(body)
+    if status != 200:
+        return status, None
+    if resp_headers.get("ETag"):
+        async with DB_LOCK:
+            await DB.execute(_SQL_UPSERT_ETAG, (url, resp_headers["ETag"], fresh))
+            await DB.commit()
+    return status, json_loads(fresh)
 
 # -------------------- GITHUB POLLING --------------------
-@tasks.loop(minutes=1)
-async def check_commits():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT id, github_username, discord_id, last_event_id FROM github_accounts")
-        accounts = await cursor.fetchall()
-
-    headers = {"Authorization": f"token {GITHUB_TOKEN}"} if GITHUB_TOKEN else {}
-    now = datetime.utcnow()
-
-    for acc_id, username, discord_id, last_event_id in accounts:
-        repos = await get_public_repos(username)
-        if not repos:
-            print(f"No public repos found for {username}")
-            continue
-
-        async with aiohttp.ClientSession() as session:
-            new_commits = []
-
-            for repo in repos:
-                commits_url = f"https://api.github.com/repos/{username}/{repo}/commits?per_page=10"
-                async with session.get(commits_url, headers=headers) as resp:
-                    if resp.status != 200:
-                        print(f"⚠️ Failed to fetch commits for {repo}: {resp.status}")
-                        continue
-                    commits = await resp.json()
-                    for commit in commits:
-                        sha = commit["sha"]
-                        commit_date = datetime.strptime(commit["commit"]["author"]["date"], "%Y-%m-%dT%H:%M:%SZ")
-                        if last_event_id and sha == last_event_id:
-                            break  # stop once we reach last seen commit
-                        if now - commit_date <= timedelta(days=7):  # only last week
-                            new_commits.append((repo, commit, commit_date))
-
-            if new_commits:
-                # Only take the newest commit per repo
-                newest_commits = {}
-                for repo_name, commit, commit_date in new_commits:
-                    if repo_name not in newest_commits or commit_date > newest_commits[repo_name][1]:
-                        newest_commits[repo_name] = (commit, commit_date)
-
-                # Update last_event_id to the most recent commit overall
-                most_recent_sha = max(newest_commits.values(), key=lambda x: x[1])[0]["sha"]
-                async with aiosqlite.connect(DB_PATH) as db:
-                    await db.execute(
-                        "UPDATE github_accounts SET last_event_id = ? WHERE id = ?",
-                        (most_recent_sha, acc_id)
-                    )
-                    await db.commit()
-
-                # Determine Discord channel
-                channel = None
-                if bot.guilds:
-                    async with aiosqlite.connect(DB_PATH) as db:
-                        cursor = await db.execute(
-                            "SELECT update_channel_id FROM settings WHERE guild_id = ?",
-                            (bot.guilds[0].id,)
-                        )
-                        row = await cursor.fetchone()
-                        channel_id = row[0] if row else None
-                    channel = bot.get_channel(channel_id) if channel_id else discord.utils.get(
-                        bot.guilds[0].channels, name="github-activity"
+def events_url(username):
+    # Single source for the feed URL so stored ETags always match the request
+    return f"https://api.github.com/users/{username}/events/public?per_page={EVENTS_PER_PAGE}"
+
+
+async def _check_one(acc, sem, cutoff):
+    acc_id, username, guild_id = acc["id"], acc["github_username"], acc["guild_id"]
+    last_event_id, etag = acc["last_event_id"], acc["etag"]
+    # GitHub tells each client how long to wait before polling a feed again;
+    # the slack absorbs loop jitter so an interval equal to the loop's own
+    # period doesn't skip every other cycle
+    started = time.monotonic()
+    if started + POLL_SLACK < NEXT_POLL.get(acc_id, 0):
+        return None
+    # One conditional request per account: the public events feed covers
+    # every repo, and the stored ETag turns "nothing new" into an empty 304
+    async with sem:
+        status, resp_headers, events = await github_get(events_url(username), etag)
+    # Measured from before the request, as the loop itself runs at a fixed rate
+    NEXT_POLL[acc_id] = started + int(resp_headers.get("X-Poll-Interval", POLL_INTERVAL))
+    if status == 304:
+        return None
+    if status != 200:
+        print(f"⚠️ Failed to fetch events for {username}: {status}")
+        return None
+    etag = resp_headers.get("ETag")
+
+    # Cursors stored before the switch to the events feed were commit SHAs;
+    # re-seed those from the feed instead of replaying the whole week
+    if last_event_id and not last_event_id.isdigit():
+        last_event_id = next((e["id"] for e in events if e["type"] == "PushEvent"), None)
+        return (last_event_id, etag, acc_id)
+
+    newest_pushes = {}
+    new_count = 0
+    page, page_no = events, 1
+    while True:
+        for event in page:
+            # Checked for every event type, so a page of old non-push activity
+            # still ends the scan (and the paging below)
+            if event["created_at"] < cutoff:
+                break  # only last week; the feed is newest-first so the rest is older
+            if event["type"] != "PushEvent":
+                continue
+            if last_event_id and event["id"] == last_event_id:
+                break  # stop once we reach last seen event
+            # Only take the newest push per repo, which is the first one seen
+            newest_pushes.setdefault(event["repo"]["name"], event)
+            new_count += 1
+            if new_count >= MAX_NEW_EVENTS:
+                break
+        else:
+            # Nothing on this page was seen before or older than the cutoff,
+            # so the next page may still hold new pushes
+            if len(page) == EVENTS_PER_PAGE and page_no < MAX_EVENT_PAGES:
+                page_no += 1
+                async with sem:
+                    status, _, page = await github_get(
+                        f"{events_url(username)}&page={page_no}"
                     )
+                if status == 200:
+                    continue
+        break
+
+    if newest_pushes:
+        # The feed is newest-first and dicts keep insertion order, so the
+        # first push stored is the most recent one overall
+        last_event_id = next(iter(newest_pushes.values()))["id"]
+
+        # Determine Discord channel; accounts linked before guild_id was
+        # recorded fall back to the first guild, as before
+        guild = bot.get_guild(guild_id) if guild_id else bot.guilds[0]
+        channel = update_channel(guild) if guild else None
+
+        if channel:
+            # One message per account per cycle, with a section for each repo
+            sections = []
+            for repo_name, event in newest_pushes.items():
+                payload = event["payload"]
+                commits = payload.get("commits") or []
+                if commits:
+                    commit = commits[-1]  # head commit of the push
+                    # Newest commits, so the linked head commit is always listed
+                    shown = commits[-MAX_COMMITS_PER_PUSH:]
+                    message = "\n".join("- " + c["message"] for c in shown)
+                    # The feed caps the commit list; "size" is the push's real total
+                    total = payload.get("size", len(commits))
+                    if total > len(shown):
+                        message += f"\n…and {total - len(shown)} earlier"
+                    author_name = commit["author"]["name"]
+                    head_sha = commit["sha"]
+                else:
+                    # Trimmed feed payloads may omit the commit list; still post
+                    # the push, crediting the pusher and linking the head commit
+                    head_sha = payload.get("head")
+                    if not head_sha:
+                        print(f"⚠️ Push {event['id']} to {repo_name} has no head commit, skipping")
+                        continue
+                    message = "- (commit list not included in the event)"
+                    author_name = event["actor"]["login"]
+                html_url = f"https://github.com/{repo_name}/commit/{head_sha}"
+                sections.append(f"🔨 **{username}** pushed to **{repo_name}** by **{author_name}**:\n{message}\n<{html_url}>")
+            try:
+                for content in chunk_message(sections, "\n\n"):
+                    await channel.send(content)
+            except discord.HTTPException as e:
+                # Still advance the cursor: retrying would repost what did get through
+                print(f"⚠️ Failed to post pushes for {username}: {e}")
+            else:
+                if sections:
+                    print(f"Posted {len(sections)} push(es) to Discord for {username}")
 
-                if channel:
-                    for repo_name, (commit, commit_date) in newest_commits.items():
-                        message = commit["commit"]["message"]
-                        author_name = commit["commit"]["author"]["name"]
-                        html_url = commit["html_url"]
-                        await channel.send(f"🔨 **{username}** pushed to **{repo_name}** by **{author_name}**:\n- {message}\n<{html_url}>")
-                        print(f"Posted commit to Discord for {username}/{repo_name}")
+    # Cursor + ETag row for the batched UPDATE in check_commits
+    return (last_event_id, etag, acc_id)
+
+@tasks.loop(seconds=POLL_INTERVAL)
+async def check_commits():
+    accounts = await DB.execute_fetchall(_SQL_SELECT_ACCOUNTS)
+    if not bot.guilds or not accounts:
+        return  # nowhere to post or nothing to poll
+
+    # One cutoff for the whole cycle, in GitHub's fixed-width UTC format so
+    # created_at strings compare against it without being parsed
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=7)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    # Accounts are polled concurrently; the semaphore caps in-flight GitHub work
+    sem = asyncio.Semaphore(16)
+    results = await asyncio.gather(*[_check_one(acc, sem, cutoff) for acc in accounts], return_exceptions=True)
+
+    # One transaction for the whole cycle instead of a commit per account; one
+    # account failing must not drop the cursors of accounts that already posted
+    updates = []
+    for acc, result in zip(accounts, results):
+        if isinstance(result, Exception):
+            # Its cursor isn't saved, so this repeats each cycle until fixed
+            print(f"⚠️ Error checking {acc['github_username']}:")
+            traceback.print_exception(result)
+        elif result:
+            updates.append(result)
+    if updates:
+        async with DB_LOCK:
+            try:
+                # Take the write lock up front so WAL never has to upgrade a read lock
+                await DB.execute("BEGIN IMMEDIATE")
+                await DB.executemany(_SQL_UPDATE_CURSOR, updates)
+                await DB.commit()
+            except Exception as e:
+                await DB.rollback()
+                print(f"⚠️ Failed to save poll cursors: {e}")
+
+    # Per-account X-Poll-Interval is handled by NEXT_POLL; the loop itself only
+    # slows down when the remaining quota can't cover another full cycle
+    next_interval = POLL_INTERVAL
+    if RATE_LIMIT["remaining"] is not None and RATE_LIMIT["remaining"] < len(accounts):
+        next_interval = max(next_interval, RATE_LIMIT["reset"] - time.time())
+    check_commits.change_interval(seconds=next_interval)
 
 # -------------------- EVENTS --------------------
 @bot.event
@@ -129,13 +420,44 @@ async def on_ready():
     except Exception as e:
         print(f"⚠️ Error syncing commands: {e}")
 
+def _forget_update_channel(channel):
+    # Drop a stale UPDATE_CHANNELS entry; guilds without a configured channel
+    # re-resolve by name since #github-activity may have appeared or moved
+    cached = UPDATE_CHANNELS.get(channel.guild.id)
+    if cached is not None and (cached.id == channel.id or channel.guild.id not in CHANNEL_CACHE):
+        UPDATE_CHANNELS.pop(channel.guild.id, None)
+
+@bot.event
+async def on_guild_channel_create(channel):
+    _forget_update_channel(channel)
+
 @bot.event
-async def setup_hook():
-    await init_db()
-    check_commits.start()
+async def on_guild_channel_delete(channel):
+    _forget_update_channel(channel)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    _forget_update_channel(after)
+
+@bot.tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: discord.app_commands.AppCommandError):
+    if isinstance(error, discord.app_commands.MissingPermissions):
+        await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
+        return
+    print(f"⚠️ Error in /{interaction.command.name if interaction.command else '?'}:")
+    traceback.print_exception(error)
+    # add_github and friends may already have deferred, so pick the right reply channel
+    send = interaction.followup.send if interaction.response.is_done() else interaction.response.send_message
+    try:
+        await send("⚠️ Something went wrong while running this command.", ephemeral=True)
+    except discord.HTTPException:
+        pass
 
 # -------------------- GAMES --------------------
 class RPSView(discord.ui.View):
+    # (challenger choice, opponent choice) pairs the challenger wins
+    _RULES = {("Rock", "Scissors"): 1, ("Paper", "Rock"): 1, ("Scissors", "Paper"): 1}
+
     def __init__(self, challenger: discord.Member, opponent: discord.Member):
         super().__init__(timeout=180)  # 3 min to play
         self.challenger = challenger
@@ -185,11 +507,7 @@ class RPSView(discord.ui.View):
     def get_winner(self, c1, c2):
         if c1 == c2:
             return 0
-        if (c1 == "Rock" and c2 == "Scissors") or \
-           (c1 == "Paper" and c2 == "Rock") or \
-           (c1 == "Scissors" and c2 == "Paper"):
-            return 1
-        return 2
+        return self._RULES.get((c1, c2), 2)
 
 class RPSButton(discord.ui.Button):
     def __init__(self, label, emoji):
@@ -211,7 +529,7 @@ class TicTacToeButton(Button):
             await interaction.response.send_message("❌ It's not your turn!", ephemeral=True)
             return
 
-        if view.board[self.y][self.x] != "⬜":
+        if view.board[self.y * 3 + self.x] != "⬜":
             await interaction.response.send_message("❌ That spot is already taken!", ephemeral=True)
             return
 
@@ -219,7 +537,7 @@ class TicTacToeButton(Button):
         self.label = symbol
         self.style = discord.ButtonStyle.danger if symbol == "❌" else discord.ButtonStyle.primary
         self.disabled = True
-        view.board[self.y][self.x] = symbol
+        view.board[self.y * 3 + self.x] = symbol
         view.turn += 1
 
         winner = view.check_winner()
@@ -241,13 +559,18 @@ class TicTacToeButton(Button):
 
 
 class TicTacToe(View):
+    # Index triples into the flat board: rows, cols, diagonals
+    LINES = ((0, 1, 2), (3, 4, 5), (6, 7, 8),
+             (0, 3, 6), (1, 4, 7), (2, 5, 8),
+             (0, 4, 8), (2, 4, 6))
+
     def __init__(self, player1, player2):
         super().__init__(timeout=180)  # 3 minutes max
         self.player1 = player1
         self.player2 = player2
         self.current_player = player1
         self.turn = 0
-        self.board = [["⬜"] * 3 for _ in range(3)]
+        self.board = ["⬜"] * 9  # row-major, index y * 3 + x
 
         for y in range(3):
             for x in range(3):
@@ -260,79 +583,154 @@ class TicTacToe(View):
             await self.message.edit(content="⌛ Tic-Tac-Toe timed out due to inactivity.", view=self)
         self.stop()
     def check_winner(self):
-        lines = []
-        # rows and cols
-        for i in range(3):
-            lines.append(self.board[i])  # row
-            lines.append([self.board[0][i], self.board[1][i], self.board[2][i]])  # col
-        # diagonals
-        lines.append([self.board[0][0], self.board[1][1], self.board[2][2]])
-        lines.append([self.board[0][2], self.board[1][1], self.board[2][0]])
-
-        for line in lines:
-            if line[0] != "⬜" and line.count(line[0]) == 3:
-                return line[0]
+        board = self.board
+        for a, b, c in self.LINES:
+            if board[a] != "⬜" and board[a] == board[b] == board[c]:
+                return board[a]
         return None
 
 # -------------------- HELPER: FETCH PUBLIC REPOS --------------------
-async def get_public_repos(username):
+# Returns (status, names) so callers can tell a rate-limited lookup apart
+# from a user with no public repos
+async def get_public_repos(username, wait=True):
+    cached = REPO_CACHE.get(username.lower())
+    if cached and time.monotonic() - cached[0] < REPO_CACHE_TTL:
+        return 200, cached[1]
     url = f"https://api.github.com/users/{username}/repos?per_page=100&type=owner"
-    headers = {"Authorization": f"token {GITHUB_TOKEN}"} if GITHUB_TOKEN else {}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as resp:
+    status, repos = await cached_get(url, wait)
+    if status != 200:
+        print(f"⚠️ Failed to fetch repos for {username}: {status}")
+        return status, []
+    names = [repo["name"] for repo in repos if not repo["private"]]
+    # Empty lists aren't cached so a newly published first repo shows up on retry
+    if names:
+        REPO_CACHE[username.lower()] = (time.monotonic(), names)
+    return status, names
+
+# -------------------- HELPER: COUNT STREAK --------------------
+def count_streak(weeks, window_start, window_end):
+    # Returns (days, broken): consecutive contribution days counted back from
+    # window_end, and whether a day without contributions ended the run.
+    # Weeks and their days come back oldest-first, so walk both in reverse
+    # and stop at the first empty day
+    days = 0
+    for week in reversed(weeks):
+        for day in reversed(week["contributionDays"]):
+            day_date = date.fromisoformat(day["date"])
+            if day_date > window_end:
+                continue
+            if day_date < window_start:
+                return days, False
+            if day["contributionCount"] > 0:
+                days += 1
+            else:
+                return days, True
+    return days, False
+
+# -------------------- GRAPHQL QUERIES --------------------
+STREAK_QUERY = """
+query($username: String!, $from: DateTime!, $to: DateTime!) {
+  user(login: $username) {
+    contributionsCollection(from: $from, to: $to) {
+      contributionCalendar {
+        weeks {
+          contributionDays {
+            date
+            contributionCount
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+STREAK_REPO_QUERY = """
+query($username: String!, $repoName: String!, $from: DateTime!, $to: DateTime!) {
+  user(login: $username) {
+    contributionsCollection(repositoryName: $repoName, from: $from, to: $to) {
+      contributionCalendar {
+        weeks {
+          contributionDays {
+            date
+            contributionCount
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+# -------------------- HELPER: FETCH STREAK --------------------
+async def fetch_streak(username, repo_name=None):
+    # Returns (streak, error); error is a message for the user when a query fails
+    query = STREAK_REPO_QUERY if repo_name else STREAK_QUERY
+    streak = 0
+    done = False
+    window_end = datetime.now(timezone.utc).date()
+    window_days = STREAK_WINDOW_DAYS
+    # Only ask for a short window of the calendar; if the streak covers all of
+    # it, step back a full year at a time so long streaks stay a few requests
+    while not done:
+        window_start = window_end - timedelta(days=window_days - 1)
+        variables = {"username": username, "from": f"{window_start.isoformat()}T00:00:00Z", "to": f"{window_end.isoformat()}T23:59:59Z"}
+        if repo_name:
+            variables["repoName"] = repo_name
+        async with HTTP_SESSION.post("https://api.github.com/graphql", json={"query": query, "variables": variables}) as resp:
             if resp.status != 200:
-                print(f"⚠️ Failed to fetch repos for {username}: {resp.status}")
-                return []
-            repos = await resp.json()
-            return [repo["name"] for repo in repos if not repo["private"]]
+                return streak, f"⚠️ Failed to fetch data: {resp.status}"
+            data = json_loads(await resp.read())
+        if "errors" in data:
+            return streak, f"⚠️ Error: {data['errors'][0]['message']}"
+        weeks = data["data"]["user"]["contributionsCollection"]["contributionCalendar"]["weeks"]
+        if not weeks:
+            break
+        days, done = count_streak(weeks, window_start, window_end)
+        streak += days
+        window_end = window_start - timedelta(days=1)
+        window_days = STREAK_MAX_WINDOW_DAYS
+    return streak, None
 
 # -------------------- SLASH COMMANDS --------------------
 @bot.tree.command(name="add_github", description="Link a GitHub account to a Discord user")
-@commands.has_permissions(administrator=True)
+@discord.app_commands.default_permissions(administrator=True)
+@discord.app_commands.checks.has_permissions(administrator=True)
 async def add_github(interaction: discord.Interaction, github_username: str, user: discord.Member = None):
     await interaction.response.defer()
     discord_id = user.id if user else None
+    rate_limited = f"⏳ GitHub rate limit reached, try linking **{github_username}** again later"
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "INSERT INTO github_accounts (github_username, discord_id, last_event_id) VALUES (?, ?, ?)",
-            (github_username, discord_id, None)
-        )
-        acc_id = cursor.lastrowid
-        await db.commit()
-
-    headers = {"Authorization": f"token {GITHUB_TOKEN}"} if GITHUB_TOKEN else {}
-
-    # Fetch all public repos
-    public_repos = await get_public_repos(github_username)
+    # GitHub lookups come first and don't wait out a low quota, so a
+    # rate-limited attempt replies in time and links nothing
+    status, public_repos = await get_public_repos(github_username, wait=False)
+    if status == 429:
+        await interaction.followup.send(rate_limited)
+        return
     if not public_repos:
         await interaction.followup.send(f"❌ No public repos found for {github_username}")
         return
 
-    newest_event_id = None
+    # Seed the cursor and ETag from the same feed check_commits polls: one
+    # request covers every repo, and the feed is newest-first
+    status, resp_headers, events = await github_get(events_url(github_username), wait=False)
+    if status == 429:
+        await interaction.followup.send(rate_limited)
+        return
 
-    async with aiohttp.ClientSession() as session:
-        for repo in public_repos:
-            repo_url = f"https://api.github.com/repos/{github_username}/{repo}/events"
-            async with session.get(repo_url, headers=headers) as resp:
-                if resp.status != 200:
-                    continue
-                events = await resp.json()
-                for event in events:
-                    if event["type"] == "PushEvent":
-                        # Always keep the newest event ID (highest/latest)
-                        if not newest_event_id or event["created_at"] > newest_event_id:
-                            newest_event_id = event["id"]
-                        break  # only need the latest PushEvent per repo
-
-    # Update DB with the newest event ID
-    if newest_event_id:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "UPDATE github_accounts SET last_event_id = ? WHERE id = ?",
-                (newest_event_id, acc_id)
-            )
-            await db.commit()
+    # Re-linking an existing account updates it in place, keeping its id;
+    # lastrowid isn't reliable after an upsert, so look the id up instead
+    async with DB_LOCK:
+        await DB.execute(_SQL_UPSERT_ACCOUNT, (github_username, discord_id, None, interaction.guild_id))
+        await DB.commit()
+    rows = await DB.execute_fetchall(_SQL_SELECT_ACCOUNT_ID, (github_username,))
+    acc_id = rows[0]["id"]
+
+    if status == 200:
+        newest_event_id = next((e["id"] for e in events if e["type"] == "PushEvent"), None)
+        async with DB_LOCK:
+            await DB.execute(_SQL_UPDATE_CURSOR, (newest_event_id, resp_headers.get("ETag"), acc_id))
+            await DB.commit()
         print(f"First-run setup for {github_username}, storing last_event_id {newest_event_id}")
 
     await interaction.followup.send(
@@ -370,151 +768,75 @@ async def game(interaction: discord.Interaction, game_name: discord.app_commands
         await interaction.response.send_message(f"❌ Unknown game: {game_name.value}")
 
 @bot.tree.command(name="remove_github", description="Remove a GitHub account")
-@commands.has_permissions(administrator=True)
+@discord.app_commands.default_permissions(administrator=True)
+@discord.app_commands.checks.has_permissions(administrator=True)
 async def remove_github(interaction: discord.Interaction, github_username: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM github_accounts WHERE github_username = ?", (github_username,))
-        await db.commit()
+    async with DB_LOCK:
+        await DB.execute(_SQL_DELETE_ACCOUNT, (github_username,))
+        await DB.commit()
+    REPO_CACHE.pop(github_username.lower(), None)
     await interaction.response.send_message(f"🗑️ Removed **{github_username}**")
 
 @bot.tree.command(name="list_githubs", description="List linked GitHub accounts")
 async def list_githubs(interaction: discord.Interaction, user: discord.Member = None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        if user:
-            cursor = await db.execute("SELECT github_username FROM github_accounts WHERE discord_id = ?", (user.id,))
-            accounts = await cursor.fetchall()
-            if accounts:
-                accounts_str = ", ".join(acc[0] for acc in accounts)
-                await interaction.response.send_message(f"📋 GitHub accounts for {user.mention}: {accounts_str}")
-            else:
-                await interaction.response.send_message(f"❌ No GitHub accounts linked for {user.mention}")
+    if user:
+        accounts = await DB.execute_fetchall(_SQL_SELECT_USER_ACCOUNTS, (user.id,))
+        if accounts:
+            accounts_str = ", ".join(acc["github_username"] for acc in accounts)
+            await interaction.response.send_message(f"📋 GitHub accounts for {user.mention}: {accounts_str}")
         else:
-            cursor = await db.execute("SELECT github_username, discord_id FROM github_accounts")
-            accounts = await cursor.fetchall()
-            if accounts:
-                msg = "📋 Linked GitHub accounts:\n"
-                for acc in accounts:
-                    discord_user = f"<@{acc[1]}>" if acc[1] else "(unlinked)"
-                    msg += f"- {acc[0]} → {discord_user}\n"
-                await interaction.response.send_message(msg)
-            else:
-                await interaction.response.send_message("❌ No GitHub accounts linked yet.")
+            await interaction.response.send_message(f"❌ No GitHub accounts linked for {user.mention}")
+    else:
+        accounts = await DB.execute_fetchall(_SQL_SELECT_LINKS)
+        if accounts:
+            lines = ["📋 Linked GitHub accounts:"]
+            for acc in accounts:
+                discord_user = f"<@{acc['discord_id']}>" if acc["discord_id"] else "(unlinked)"
+                lines.append(f"- {acc['github_username']} → {discord_user}")
+            first, *rest = chunk_message(lines)
+            await interaction.response.send_message(first)
+            for content in rest:
+                await interaction.followup.send(content)
+        else:
+            await interaction.response.send_message("❌ No GitHub accounts linked yet.")
 
 @bot.tree.command(name="change_github", description="Change Discord account associated with a GitHub account")
-@commands.has_permissions(administrator=True)
+@discord.app_commands.default_permissions(administrator=True)
+@discord.app_commands.checks.has_permissions(administrator=True)
 async def change_github(interaction: discord.Interaction, github_username: str, user: discord.Member):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE github_accounts SET discord_id = ? WHERE github_username = ?",
-            (user.id, github_username)
-        )
-        await db.commit()
+    async with DB_LOCK:
+        await DB.execute(_SQL_UPDATE_DISCORD, (user.id, github_username))
+        await DB.commit()
     await interaction.response.send_message(f"✅ **{github_username}** is now linked to {user.mention}")
 
 @bot.tree.command(name="current_streak", description="Show current contribution streak for a GitHub user")
 async def current_streak(interaction: discord.Interaction, github_username: str):
-    query = """
-    query($username: String!) {
-      user(login: $username) {
-        contributionsCollection {
-          contributionCalendar {
-            weeks {
-              contributionDays {
-                date
-                contributionCount
-              }
-            }
-          }
-        }
-      }
-    }
-    """
-    headers = {"Authorization": f"bearer {GITHUB_TOKEN}"}
-    async with aiohttp.ClientSession() as session:
-        async with session.post("https://api.github.com/graphql", json={"query": query, "variables": {"username": github_username}}, headers=headers) as resp:
-            if resp.status != 200:
-                await interaction.response.send_message(f"⚠️ Failed to fetch data: {resp.status}")
-                return
-            data = await resp.json()
-    if "errors" in data:
-        await interaction.response.send_message(f"⚠️ Error: {data['errors'][0]['message']}")
+    await interaction.response.defer()  # long streaks take several GraphQL windows
+    streak, error = await fetch_streak(github_username)
+    if error:
+        await interaction.followup.send(error)
         return
-    weeks = data["data"]["user"]["contributionsCollection"]["contributionCalendar"]["weeks"]
-    streak = 0
-    counting = True
-    today = datetime.utcnow().date()
-    days = [day for week in weeks for day in week["contributionDays"]]
-    days = sorted(days, key=lambda x: x["date"], reverse=True)
-    for day in days:
-        day_date = datetime.strptime(day["date"], "%Y-%m-%d").date()
-        if day_date > today:
-            continue
-        if counting:
-            if day["contributionCount"] > 0:
-                streak += 1
-            else:
-                counting = False
-        else:
-            break
-    await interaction.response.send_message(f"🔥 **{github_username}** current contribution streak: **{streak} day(s)**")
+    await interaction.followup.send(f"🔥 **{github_username}** current contribution streak: **{streak} day(s)**")
 
 @bot.tree.command(name="streak_repo", description="Show current contribution streak for a user in a specific repository")
 async def streak_repo(interaction: discord.Interaction, github_username: str, repo_name: str):
-    query = """
-    query($username: String!, $repoName: String!) {
-      user(login: $username) {
-        contributionsCollection(repositoryName: $repoName) {
-          contributionCalendar {
-            weeks {
-              contributionDays {
-                date
-                contributionCount
-              }
-            }
-          }
-        }
-      }
-    }
-    """
-    headers = {"Authorization": f"bearer {GITHUB_TOKEN}"}
-    async with aiohttp.ClientSession() as session:
-        async with session.post("https://api.github.com/graphql", json={"query": query, "variables": {"username": github_username, "repoName": repo_name}}, headers=headers) as resp:
-            if resp.status != 200:
-                await interaction.response.send_message(f"⚠️ Failed to fetch data: {resp.status}")
-                return
-            data = await resp.json()
-    if "errors" in data:
-        await interaction.response.send_message(f"⚠️ Error: {data['errors'][0]['message']}")
+    await interaction.response.defer()  # long streaks take several GraphQL windows
+    streak, error = await fetch_streak(github_username, repo_name)
+    if error:
+        await interaction.followup.send(error)
         return
-    weeks = data["data"]["user"]["contributionsCollection"]["contributionCalendar"]["weeks"]
-    streak = 0
-    counting = True
-    today = datetime.utcnow().date()
-    days = [day for week in weeks for day in week["contributionDays"]]
-    days = sorted(days, key=lambda x: x["date"], reverse=True)
-    for day in days:
-        day_date = datetime.strptime(day["date"], "%Y-%m-%d").date()
-        if day_date > today:
-            continue
-        if counting:
-            if day["contributionCount"] > 0:
-                streak += 1
-            else:
-                counting = False
-        else:
-            break
-    await interaction.response.send_message(f"🔥 **{github_username}** streak in **{repo_name}**: **{streak} day(s)**")
+    await interaction.followup.send(f"🔥 **{github_username}** streak in **{repo_name}**: **{streak} day(s)**")
 
 # -------------------- OPTIONAL: SET UPDATE CHANNEL --------------------
 @bot.tree.command(name="set_github_channel", description="Set the channel for GitHub updates")
-@commands.has_permissions(administrator=True)
+@discord.app_commands.default_permissions(administrator=True)
+@discord.app_commands.checks.has_permissions(administrator=True)
 async def set_github_channel(interaction: discord.Interaction, channel: discord.TextChannel):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR REPLACE INTO settings (guild_id, update_channel_id) VALUES (?, ?)",
-            (interaction.guild.id, channel.id)
-        )
-        await db.commit()
+    async with DB_LOCK:
+        await DB.execute(_SQL_UPSERT_CHANNEL, (interaction.guild.id, channel.id))
+        await DB.commit()
+    CHANNEL_CACHE[interaction.guild.id] = channel.id
+    UPDATE_CHANNELS[interaction.guild.id] = channel
     await interaction.response.send_message(f"✅ GitHub updates will now post in {channel.mention}")
 
 # -------------------- RUN BOT --------------------